@@ -18,23 +18,29 @@ import argparse
 import json
 import logging
 import uuid
-from random import sample
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from random import choice
 
+from cassandra import ConsistencyLevel
 from cassandra.auth import PlainTextAuthProvider
-import cassandra.concurrent
 from cassandra.cluster import Cluster
-from cassandra.policies import RoundRobinPolicy, TokenAwarePolicy
-from solrcloudpy import SolrConnection, SearchOptions
-
-from six.moves import input
-
-solr_connection = None
-solr_collection = None
+from cassandra.policies import DCAwareRoundRobinPolicy, HostDistance, TokenAwarePolicy
+import requests
+from requests.adapters import HTTPAdapter
+
+solr_http = None
+solr_url = None
+solr_timeout = None
+solr_update_timeout = None
 SOLR_UNIQUE_KEY = None
 
 cassandra_cluster = None
 cassandra_session = None
 cassandra_table = None
+delete_statement = None
+CASSANDRA_CONCURRENCY = None
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
@@ -45,14 +51,20 @@ logging.getLogger('cassandra').setLevel(logging.CRITICAL)
 
 
 def init(args):
-    global solr_connection
-    solr_connection = SolrConnection(args.solr)
-    global solr_collection
-    solr_collection = solr_connection[args.collection]
+    global solr_http
+    solr_http = requests.Session()
+    solr_http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=3))
+    solr_http.params = {'wt': 'json'}
+    global solr_url
+    solr_url = 'http://%s/solr/%s' % (args.solr, args.collection)
+    global solr_timeout
+    solr_timeout = args.solrTimeout
+    global solr_update_timeout
+    solr_update_timeout = args.solrUpdateTimeout
     global SOLR_UNIQUE_KEY
     SOLR_UNIQUE_KEY = args.solrIdField
 
-    dc_policy = RoundRobinPolicy()
+    dc_policy = DCAwareRoundRobinPolicy(local_dc=args.cassandraLocalDc)
     token_policy = TokenAwarePolicy(dc_policy)
 
     if args.cassandraUsername and args.cassandraPassword:
@@ -65,44 +77,76 @@ def init(args):
                                 protocol_version=int(args.cassandraProtocolVersion),
                                 load_balancing_policy=token_policy,
                                 auth_provider=auth_provider)
+    # Protocol v3+ multiplexes requests over a single connection per host; older versions need a larger pool
+    if cassandra_cluster.protocol_version < 3:
+        cassandra_cluster.set_core_connections_per_host(HostDistance.LOCAL, 4)
+        cassandra_cluster.set_max_connections_per_host(HostDistance.LOCAL, 8)
     global cassandra_session
     cassandra_session = cassandra_cluster.connect(keyspace=args.cassandraKeyspace)
 
     global cassandra_table
-    cassandra_table = args.cassandraTable
+    cassandra_table = cql_table_name(args.cassandraTable)
+    global CASSANDRA_CONCURRENCY
+    CASSANDRA_CONCURRENCY = args.concurrency
+
+    # Each tile is its own partition, so a delete by tile_id already targets exactly one partition and there is
+    # nothing to group into range deletes. Fail fast on any other layout rather than on every single delete.
+    keyspace_metadata = cassandra_cluster.metadata.keyspaces.get(args.cassandraKeyspace)
+    table_metadata = keyspace_metadata.tables.get(cassandra_table) if keyspace_metadata is not None else None
+    if table_metadata is None:
+        raise RuntimeError("table %s.%s does not exist" % (args.cassandraKeyspace, cassandra_table))
+    partition_key = [column.name for column in table_metadata.partition_key]
+    if partition_key != ['tile_id']:
+        raise RuntimeError("expected tile_id to be the partition key of %s but found %s" % (cassandra_table, partition_key))
+
+    global delete_statement
+    delete_statement = cassandra_session.prepare('DELETE FROM "%s" WHERE tile_id=?' % cassandra_table.replace('"', '""'))
+    # Route each delete straight to a replica of its tile; deletes are safe to retry or speculatively re-send
+    delete_statement.routing_key_indexes = [0]
+    delete_statement.consistency_level = ConsistencyLevel.LOCAL_ONE
+    delete_statement.is_idempotent = True
+
+
+def cql_table_name(name):
+    # Resolve the name the way CQL does: unquoted identifiers are case-insensitive, quoted ones are taken verbatim
+    if len(name) > 1 and name.startswith('"') and name.endswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
 
 
 def delete_by_query(args):
-    if args.query:
-        se = SearchOptions()
-        se.commonparams.q(args.query) \
-            .fl(SOLR_UNIQUE_KEY) \
-            .fl('id')
-
-        for fq in args.filterquery if args.filterquery is not None else []:
-            se.commonparams.fq(fq)
+    # Only the unique key (used to sort the cursor) and the tile id are needed to drive the deletes
+    id_fields = SOLR_UNIQUE_KEY if SOLR_UNIQUE_KEY == 'id' else '%s,id' % SOLR_UNIQUE_KEY
 
-        query = se
+    if args.query:
+        query = {
+            'q': args.query,
+            'fl': id_fields,
+            'fq': args.filterquery if args.filterquery is not None else []
+        }
     elif args.jsonparams:
-        se = SearchOptions(**json.loads(args.jsonparams))
-        se.commonparams.fl(SOLR_UNIQUE_KEY) \
-            .fl('id')
-        query = se
+        query = json.loads(args.jsonparams)
+        # solrcloudpy accepted the query under 'query'; keep honouring that for existing invocations
+        if 'q' not in query and 'query' in query:
+            query['q'] = query.pop('query')
+        if 'q' not in query:
+            raise RuntimeError("jsonparams must include a 'q' parameter")
+        query['fl'] = id_fields
     else:
         raise RuntimeError("either query or jsonparams is required")
 
-    query.commonparams.rows(args.rows)
+    query['rows'] = args.rows
 
-    if check_query(query):
-        logging.info("Collecting tiles ....")
-        solr_docs = do_solr_query(query)
+    ok, num_found = check_query(query)
 
-        if confirm_delete(len(solr_docs)):
-            deleted_ids = do_delete(solr_docs, query)
-            logging.info("Deleted tile IDs %s" % json.dumps([str(doc_id) for doc_id in deleted_ids], indent=2))
-        else:
-            logging.info("Exiting")
-            return
+    if ok and confirm_delete(num_found):
+        ids_file = open(args.deletedIdsFile, 'a') if args.deletedIdsFile else None
+        try:
+            num_deleted = do_delete(query, ids_file)
+        finally:
+            if ids_file is not None:
+                ids_file.close()
+        logging.info("Deleted %s tile(s)" % num_deleted)
     else:
         logging.info("Exiting")
         return
@@ -120,78 +164,152 @@ def confirm_delete(num_found):
 
 
 def check_query(query):
-    solr_response = solr_collection.search(query)
-
-    num_found = solr_response.result.response.numFound
+    # Only the count is needed up front; ids to sample from are fetched if a sample is actually requested
+    num_found = solr_search(dict(query, rows=0))['response']['numFound']
+    docs = None
 
     if num_found == 0:
         logging.info("Query returned 0 results")
-        return False
-
-    do_continue = input("Query found %s matching documents. Continue? [y]/n/(s)ample: " % num_found)
+        return False, num_found
 
-    while do_continue not in ['y', 'n', 's', '']:
+    while True:
         do_continue = input("Query found %s matching documents. Continue? [y]/n/(s)ample: " % num_found)
 
-    if do_continue == 'y' or do_continue == '':
-        return True
-    elif do_continue == 'n':
-        return False
-    else:
-        se = SearchOptions()
-        se.commonparams.q('%s:%s' % (SOLR_UNIQUE_KEY, sample(solr_response.result.response.docs, 1)[0][SOLR_UNIQUE_KEY]))
-        logging.info(json.dumps(solr_collection.search(se).result.response.docs[0], indent=2))
-        return check_query(query)
+        while do_continue not in ['y', 'n', 's', '']:
+            do_continue = input("Query found %s matching documents. Continue? [y]/n/(s)ample: " % num_found)
 
+        if do_continue == 'y' or do_continue == '':
+            return True, num_found
+        elif do_continue == 'n':
+            return False, num_found
+        else:
+            if docs is None:
+                docs = solr_search(query)['response']['docs']
+            sample_query = {'q': '%s:%s' % (SOLR_UNIQUE_KEY, choice(docs)[SOLR_UNIQUE_KEY])}
+            logging.info(json.dumps(solr_search(sample_query)['response']['docs'][0], indent=2))
+
+
+def solr_search(params):
+    response = solr_http.get('%s/select' % solr_url, params=params, timeout=solr_timeout)
+    response.raise_for_status()
+    return response.json()
 
-def do_solr_query(query):
-    doc_ids = []
 
+def solr_update(body, params=None):
+    response = solr_http.post('%s/update' % solr_url, params=params, json=body, timeout=solr_update_timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_solr_pages(query):
     next_cursor_mark = "*"
-    query.commonparams.sort('%s asc' % SOLR_UNIQUE_KEY)
-    while True:
-        query.commonparams.remove_param('cursorMark')
-        query.commonparams.add_params(cursorMark=next_cursor_mark)
-        solr_response = solr_collection.search(query)
+    query['sort'] = '%s asc' % SOLR_UNIQUE_KEY
+    query['cursorMark'] = next_cursor_mark
 
-        try:
-            result_next_cursor_mark = solr_response.result.nextCursorMark
-        except AttributeError:
-            # No Results
-            return []
+    # Fetch the next page in the background while the caller deletes the current one. The query is only updated
+    # once the previous request has completed, so the cursor mark can be overwritten in place.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(solr_search, query)
+        while True:
+            solr_response = next_page.result()
 
-        if result_next_cursor_mark == next_cursor_mark:
-            break
-        else:
-            next_cursor_mark = solr_response.result.nextCursorMark
+            result_next_cursor_mark = solr_response.get('nextCursorMark')
+            if result_next_cursor_mark is None:
+                # No Results
+                return
+
+            if result_next_cursor_mark == next_cursor_mark:
+                break
+            else:
+                next_cursor_mark = result_next_cursor_mark
 
-        doc_ids.extend([uuid.UUID(doc['id']) for doc in solr_response.result.response.docs])
+            query['cursorMark'] = next_cursor_mark
+            next_page = executor.submit(solr_search, query)
+            yield solr_response['response']['docs']
 
-    return doc_ids
 
+def do_delete(query, ids_file=None):
+    pages = log_pages(iter_solr_pages(query))
+
+    # Delete-by-query only takes a single q, and filter queries cannot be folded into it safely: pure negative
+    # clauses and local params only work at the top level. Remove exactly the paged documents from Solr instead.
+    filtered = bool(query.get('fq'))
+    if filtered:
+        pages = delete_pages_from_solr(pages)
 
-def do_delete(doc_ids, query):
     logging.info("Executing Cassandra delete...")
-    delete_from_cassandra(doc_ids)
-    logging.info("Executing Solr delete...")
-    delete_from_solr(query)
-    return doc_ids
+    num_deleted = delete_from_cassandra((doc['id'] for doc in chain.from_iterable(pages)), ids_file)
+
+    if filtered:
+        logging.info("Committing Solr delete...")
+        commit_solr()
+    else:
+        logging.info("Executing Solr delete...")
+        delete_from_solr(query)
+    return num_deleted
 
 
-def delete_from_cassandra(doc_ids):
-    statement = cassandra_session.prepare("DELETE FROM %s WHERE tile_id=?" % cassandra_table)
+def log_pages(pages):
+    for docs in pages:
+        logging.info("Deleting batch of %s tile(s)" % len(docs))
+        yield docs
 
-    results = cassandra.concurrent.execute_concurrent_with_args(cassandra_session, statement,
-                                                                [(doc_id,) for doc_id in doc_ids])
 
-    for (success, result) in results:
-        if not success:
-            logging.warning("Could not delete tile %s" % result)
+def delete_pages_from_solr(pages):
+    for docs in pages:
+        solr_update({'delete': [doc[SOLR_UNIQUE_KEY] for doc in docs]})
+        yield docs
+
+
+def delete_from_cassandra(doc_ids, ids_file=None):
+    # Keep a bounded window of deletes in flight instead of building every request up front
+    in_flight = deque()
+    num_deleted = 0
+    for doc_id in doc_ids:
+        try:
+            tile_id = uuid.UUID(doc_id)
+        except ValueError:
+            logging.warning("Could not delete tile %s: not a valid tile id" % doc_id)
+            continue
+
+        if len(in_flight) >= CASSANDRA_CONCURRENCY:
+            num_deleted += wait_for_delete(*in_flight.popleft(), ids_file)
+
+        in_flight.append((doc_id, cassandra_session.execute_async(delete_statement, (tile_id,))))
+
+    while in_flight:
+        num_deleted += wait_for_delete(*in_flight.popleft(), ids_file)
+
+    return num_deleted
+
+
+def wait_for_delete(doc_id, future, ids_file):
+    try:
+        future.result()
+    except Exception as e:
+        logging.warning("Could not delete tile %s: %s" % (doc_id, e))
+        return False
+
+    if ids_file is not None:
+        ids_file.write(doc_id + '\n')
+    return True
 
 
 def delete_from_solr(query):
-    solr_collection.delete(query, commit=False)
-    solr_collection.commit()
+    # Runs only after every Cassandra delete has completed. A soft commit makes the deletion visible without forcing
+    # a segment flush; durability is left to the transaction log and Solr's own autoCommit.
+    solr_update({'delete': {'query': query['q']}}, params={'softCommit': 'true'})
+
+
+def commit_solr():
+    solr_update({}, params={'softCommit': 'true'})
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
 
 
 def parse_args():
@@ -209,6 +327,18 @@ def parse_args():
                         default='nexustiles',
                         metavar='nexustiles')
 
+    parser.add_argument('--solrTimeout',
+                        help='Timeout in seconds for Solr search requests.',
+                        required=False,
+                        default=10,
+                        type=float)
+
+    parser.add_argument('--solrUpdateTimeout',
+                        help='Timeout in seconds for the Solr delete request, which can take a while on large collections.',
+                        required=False,
+                        default=600,
+                        type=float)
+
     parser.add_argument('--solrIdField',
                         help='The name of the unique ID field for this collection.',
                         required=False,
@@ -250,6 +380,10 @@ def parse_args():
                         required=False,
                         default='9042')
 
+    parser.add_argument('--cassandraLocalDc',
+                        help='The local Cassandra datacenter. Defaults to the datacenter of the first contact point.',
+                        required=False)
+
     parser.add_argument('--cassandraUsername',
                         help='The username used to connect to Cassandra.',
                         required=False)
@@ -262,14 +396,24 @@ def parse_args():
                         help='The version of the Cassandra protocol the driver should use.',
                         required=False,
                         choices=['1', '2', '3', '4', '5'],
-                        default='3')
+                        default='4')
 
     parser.add_argument('--solr-rows',
                         help='Number of rows to fetch with each Solr query to build the list of tiles to delete',
                         required=False,
                         dest='rows',
-                        default=1000,
-                        type=int)
+                        default=10000,
+                        type=positive_int)
+
+    parser.add_argument('--concurrency',
+                        help='Maximum number of Cassandra deletes to keep in flight at once',
+                        required=False,
+                        default=256,
+                        type=positive_int)
+
+    parser.add_argument('--deletedIdsFile',
+                        help='File to append the IDs of tiles successfully deleted from Cassandra to, one per line.',
+                        required=False)
 
     return parser.parse_args()
 
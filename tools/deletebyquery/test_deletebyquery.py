@@ -0,0 +1,103 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import uuid
+from unittest import mock
+
+import deletebyquery
+
+
+class TestDoDelete(unittest.TestCase):
+    def setUp(self):
+        self.tile_ids = sorted(str(uuid.uuid4()) for _ in range(5))
+
+        pages = [
+            {'response': {'docs': [{'id': tile_id} for tile_id in self.tile_ids[:3]]}, 'nextCursorMark': 'a'},
+            {'response': {'docs': [{'id': tile_id} for tile_id in self.tile_ids[3:]]}, 'nextCursorMark': 'b'},
+            {'response': {'docs': []}, 'nextCursorMark': 'b'}
+        ]
+        self.solr_search = mock.patch.object(deletebyquery, 'solr_search', side_effect=pages).start()
+        self.solr_update = mock.patch.object(deletebyquery, 'solr_update').start()
+
+        self.cassandra_session = mock.patch.object(deletebyquery, 'cassandra_session').start()
+        mock.patch.object(deletebyquery, 'delete_statement', 'DELETE').start()
+        mock.patch.object(deletebyquery, 'SOLR_UNIQUE_KEY', 'id').start()
+        mock.patch.object(deletebyquery, 'CASSANDRA_CONCURRENCY', 2).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def deleted_tile_ids(self):
+        return sorted(str(call.args[1][0]) for call in self.cassandra_session.execute_async.call_args_list)
+
+    def test_negative_filter_query_deletes_paged_ids_from_solr(self):
+        query = {'q': '*:*', 'fq': ['-dataset_s:foo'], 'fl': 'id', 'rows': 3}
+
+        self.assertEqual(5, deletebyquery.do_delete(query))
+        self.assertEqual(self.tile_ids, self.deleted_tile_ids())
+
+        # The filter must never be nested into a delete-by-query, where a pure negative clause matches nothing
+        self.assertEqual([
+            mock.call({'delete': self.tile_ids[:3]}),
+            mock.call({'delete': self.tile_ids[3:]}),
+            mock.call({}, params={'softCommit': 'true'})
+        ], self.solr_update.call_args_list)
+
+    def test_unfiltered_query_deletes_by_query(self):
+        query = {'q': '-dataset_s:foo', 'fq': [], 'fl': 'id', 'rows': 3}
+
+        self.assertEqual(5, deletebyquery.do_delete(query))
+        self.assertEqual(self.tile_ids, self.deleted_tile_ids())
+        self.solr_update.assert_called_once_with({'delete': {'query': '-dataset_s:foo'}},
+                                                 params={'softCommit': 'true'})
+
+
+class TestCqlTableName(unittest.TestCase):
+    def test_unquoted_name_is_lower_cased(self):
+        self.assertEqual('sea_surface_temp', deletebyquery.cql_table_name('Sea_Surface_Temp'))
+
+    def test_quoted_name_is_kept_verbatim(self):
+        self.assertEqual('Sea_Surface_Temp', deletebyquery.cql_table_name('"Sea_Surface_Temp"'))
+
+
+
+class TestDeleteByQuery(unittest.TestCase):
+    def setUp(self):
+        self.check_query = mock.patch.object(deletebyquery, 'check_query', return_value=(False, 0)).start()
+        mock.patch.object(deletebyquery, 'SOLR_UNIQUE_KEY', 'id').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def args(self, jsonparams):
+        return mock.Mock(query=None, jsonparams=jsonparams, rows=10)
+
+    def test_jsonparams_query_is_mapped_to_q(self):
+        deletebyquery.delete_by_query(self.args('{"query": "dataset_s:foo"}'))
+
+        query = self.check_query.call_args.args[0]
+        self.assertEqual('dataset_s:foo', query['q'])
+        self.assertNotIn('query', query)
+
+    def test_jsonparams_without_q_is_rejected(self):
+        with self.assertRaises(RuntimeError):
+            deletebyquery.delete_by_query(self.args('{"q.alt": "*:*", "defType": "edismax"}'))
+
+        self.check_query.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()